@@ -0,0 +1,141 @@
+import math
+from collections import Counter
+from dataclasses import dataclass, replace
+
+import batt.psu as psu
+from batt.proc import ProcessStat
+from batt.system_states import SystemState
+
+
+@dataclass
+class Anomaly:
+    """A period of abnormally high drain. Powers are in mW."""
+
+    start_timestamp: int
+    end_timestamp: int
+    peak_power: int
+    expected_power: int
+    backlight_percentage: int
+    system_state: SystemState
+    top_processes: str
+
+
+@dataclass
+class EwmaStats:
+    """Exponentially weighted moving mean and variance"""
+
+    mean: float = 0.0
+    variance: float = 0.0
+    count: int = 0
+
+    def update(self, x: float, alpha: float):
+        if self.count == 0:
+            self.mean = x
+        else:
+            diff = x - self.mean
+            increment = alpha * diff
+            self.mean += increment
+            self.variance = (1 - alpha) * (self.variance + diff * increment)
+        self.count += 1
+
+    def zscore(self, x: float) -> float:
+        if self.variance <= 0:
+            return 0.0
+        return (x - self.mean) / math.sqrt(self.variance)
+
+
+class DrainDetector:
+    """Detects abnormally high drain one sample at a time.
+
+    The desmoothed power of each sample is compared to an EWMA of the power
+    seen in the same context (backlight rounded to 10% and system state).
+    Abnormal samples are left out of the EWMA so that a sustained high drain
+    does not become the expected drain while it lasts. Only the statistics
+    of each context, the previous power reading and the previous CPU ticks of
+    running processes are kept, so each update does no I/O and uses memory
+    independent of the length of the history."""
+
+    def __init__(
+        self,
+        alpha: float = 0.05,
+        threshold: float = 3.0,
+        warmup: int = 30,
+        top: int = 3,
+    ):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.warmup = warmup
+        self.top = top
+        self.stats: dict[tuple[int, SystemState], EwmaStats] = {}
+        self.prior_power: int | None = None
+        self.prior_timestamp: int | None = None
+        self.previous_ticks: dict[tuple[int, int, str], int] = {}
+        self.event: Anomaly | None = None
+        self.event_ticks: Counter[str] = Counter()
+
+    def cpu_deltas(self, procs: list[ProcessStat]) -> Counter[str]:
+        """CPU ticks used by each process name since the previous sample"""
+        deltas = Counter()
+        ticks = {}
+        for proc in procs:
+            ticks[proc.identity] = proc.utime + proc.stime
+            if (prior := self.previous_ticks.get(proc.identity)) is not None:
+                if delta := ticks[proc.identity] - prior:
+                    deltas[proc.command] += delta
+        self.previous_ticks = ticks
+        return deltas
+
+    def update(
+        self,
+        timestamp: int,
+        info: psu.BatteryInfo,
+        backlight_percentage: int,
+        state: SystemState,
+        procs: list[ProcessStat],
+    ) -> Anomaly | None:
+        """Add a sample, returning the ongoing anomaly if the sample is
+        abnormal. Samples of the same anomaly share its start_timestamp."""
+        deltas = self.cpu_deltas(procs)
+        prior, self.prior_power = self.prior_power, info.power_now
+        prior_timestamp, self.prior_timestamp = self.prior_timestamp, timestamp
+        if (
+            prior is None
+            or timestamp <= prior_timestamp
+            or info.status != psu.LowLevelBatteryStatus.Discharging
+        ):
+            self.event = None
+            return None
+
+        # Samples are an update interval apart rather than a single smoothing
+        # step, so the smoothing parameter is scaled to the elapsed time
+        alpha = psu.smoothing_alpha(timestamp - prior_timestamp)
+        power = psu.desmooth_power_reading(info.power_now, prior, alpha) / 1000
+        stats = self.stats.setdefault(
+            (round(backlight_percentage, -1), state), EwmaStats()
+        )
+        abnormal = stats.count >= self.warmup and stats.zscore(power) > self.threshold
+        expected = stats.mean
+
+        if not abnormal:
+            stats.update(power, self.alpha)
+            self.event = None
+            return None
+
+        if self.event is None:
+            self.event_ticks = Counter()
+            self.event = Anomaly(
+                start_timestamp=timestamp,
+                end_timestamp=timestamp,
+                peak_power=int(power),
+                expected_power=int(expected),
+                backlight_percentage=backlight_percentage,
+                system_state=state,
+                top_processes="",
+            )
+        self.event_ticks.update(deltas)
+        self.event.end_timestamp = timestamp
+        self.event.peak_power = max(self.event.peak_power, int(power))
+        self.event.top_processes = ",".join(
+            name for name, _ in self.event_ticks.most_common(self.top)
+        )
+        return replace(self.event)
@@ -1,3 +1,5 @@
+import os
+import select
 import time
 from dataclasses import dataclass
 from pathlib import Path
@@ -36,3 +38,49 @@ def get_backlight_reading(base_dir: Path = BASE_DIR) -> BacklightReading:
     """Get a backlight reading from the first backlight directory found"""
     first, *_ = get_backlight_directories(base_dir)
     return get_backlight_reading_from_dir(first)
+
+
+class BacklightSource:
+    """Reads the backlight from a cached device, reporting only changes.
+
+    max_brightness is read once and actual_brightness is kept open and
+    re-read with pread. The kernel notifies pollers of actual_brightness
+    when the brightness changes, so wait() can block until a change instead
+    of polling the file."""
+
+    def __init__(self, backlight_dir: Path | None = None):
+        if backlight_dir is None:
+            backlight_dir, *_ = get_backlight_directories()
+        self.backlight_dir = backlight_dir
+        with open(backlight_dir / "max_brightness") as f:
+            self.max_brightness = int(f.read().strip())
+        self.fd = os.open(backlight_dir / "actual_brightness", os.O_RDONLY)
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLPRI | select.POLLERR)
+        self.last_percentage: int | None = None
+
+    def read(self) -> BacklightReading:
+        actual = int(os.pread(self.fd, 64, 0).strip())
+        return BacklightReading(
+            timestamp=int(time.time()),
+            brightness_percentage=round(100 * actual / self.max_brightness),
+        )
+
+    def changed(self) -> BacklightReading | None:
+        """Returns a reading if the brightness changed since the last call"""
+        reading = self.read()
+        if reading.brightness_percentage == self.last_percentage:
+            return None
+        self.last_percentage = reading.brightness_percentage
+        return reading
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Block until the brightness changes or timeout (in seconds) passes,
+        returning whether a change notification was received. read() must be
+        called after each notification to re-arm it."""
+        ms = None if timeout is None else int(1000 * timeout)
+        return bool(self.poller.poll(ms))
+
+    def close(self):
+        self.poller.unregister(self.fd)
+        os.close(self.fd)
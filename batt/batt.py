@@ -17,7 +17,10 @@ class BatteryStatus:
 
     @classmethod
     def current(cls):
-        info = psu.get_current_battery_info()
+        return cls.from_info(psu.get_current_battery_info())
+
+    @classmethod
+    def from_info(cls, info: psu.BatteryInfo):
         match info.status:
             case psu.LowLevelBatteryStatus.Charging:
                 status_str = "Charging"
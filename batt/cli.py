@@ -1,33 +1,104 @@
+import signal
+import sys
 import time
-from datetime import datetime, timedelta
+from functools import cache
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
 
 import typer
 from rich.console import Console
+from rich.live import Live
+from rich.progress import Progress
+from rich.table import Table
 from rich.text import Text
 
+import batt.anomaly as anomaly
 import batt.db as db
 import batt.psu as psu
 import batt.proc as proc
 import batt.batt as batt
 import batt.system_states as system_states
 import batt.backlight as backlight
+import batt.fleet as fleet
+import batt.model as model
+import batt.report as batt_report
+import batt.watch as watch
+import batt.writer as writer
 
 app = typer.Typer()
 console = Console()
-database = db.Database.load_default()
+
+
+@cache
+def get_database() -> db.Database:
+    """The default database, opened on first use rather than at import"""
+    return db.Database.load_default()
+
+
+# Set while the updater is running so samples are written in the background
+buffered_writer: writer.BufferedWriter | None = None
+
+
+def get_sink() -> db.Database | writer.BufferedWriter:
+    """Where samples are written: the buffered writer if one is running,
+    otherwise the database directly"""
+    if buffered_writer is not None:
+        return buffered_writer
+    return get_database()
+
+
+# Most recent system state transition, read from the database on the first
+# update and then kept up to date from the transitions each update saves
+last_state_transition: system_states.StateTransition | None = None
+last_state_transition_loaded = False
+
+
+@cache
+def get_drain_detector() -> anomaly.DrainDetector:
+    """Drain detector kept across updates of the updater"""
+    return anomaly.DrainDetector()
+
+
+@cache
+def get_backlight_source() -> backlight.BacklightSource:
+    """The default backlight source, starting from the last recorded
+    brightness so that unchanged brightness is not recorded again"""
+    source = backlight.BacklightSource()
+    if (last := get_database().most_recent_backlight_reading()) is not None:
+        source.last_percentage = last.brightness_percentage
+    return source
 
 
 @app.command()
 def save_backlight_state():
-    reading = backlight.get_backlight_reading()
-    database.insert_backlight_reading(reading)
+    if (reading := get_backlight_source().changed()) is not None:
+        get_sink().insert_backlight_reading(reading)
+
+
+@app.command()
+def backlight_logger(
+    timeout: int = typer.Option(
+        60,
+        "--timeout",
+        "-t",
+        help=(
+            "Maximum time (in seconds) between checks, for devices that do "
+            "not notify brightness changes"
+        ),
+    ),
+):
+    source = get_backlight_source()
+    while True:
+        save_backlight_state()
+        source.wait(timeout)
 
 
 @app.command()
 def save_battery_status():
     current_battery_info = psu.get_current_battery_info()
     timestamp = int(time.time())
-    database.insert_battery_status(current_battery_info, timestamp)
+    get_sink().insert_battery_status(current_battery_info, timestamp)
+    return current_battery_info
 
 
 @app.command()
@@ -36,30 +107,54 @@ def save_recent_state_transitions(
         help="Add system state transitions starting from the provided date"
     ),
 ):
+    sink = get_sink()
     recent_st = system_states.get_recent_system_state_transitions(since)
     for st in recent_st:
-        database.insert_state_transition(st)
+        sink.insert_state_transition(st)
+    return recent_st
 
 
 @app.command()
 def save_proc_status():
+    sink = get_sink()
     all_proc_stats = proc.get_all_proc_stats()
     for ps in all_proc_stats:
-        database.insert_process_stat(ps)
+        sink.insert_process_stat(ps)
+    sink.prune_process_identity_cache(all_proc_stats)
+    return all_proc_stats
 
 
 @app.command()
 def update_all():
-    last_system_state_transition = database.most_recent_system_state()
-    if last_system_state_transition is None:
+    global last_state_transition, last_state_transition_loaded
+    if not last_state_transition_loaded:
+        last_state_transition = get_database().most_recent_system_state()
+        last_state_transition_loaded = True
+    if last_state_transition is None:
         since = datetime.now() - timedelta(days=90)
     else:
-        since = datetime.fromtimestamp(last_system_state_transition.timestamp + 1)
+        since = datetime.fromtimestamp(last_state_transition.timestamp + 1)
 
-    save_battery_status()
-    save_recent_state_transitions(since)
+    info = save_battery_status()
+    transitions = save_recent_state_transitions(since)
     save_backlight_state()
-    save_proc_status()
+    proc_stats = save_proc_status()
+
+    if transitions:
+        last_state_transition = max(transitions, key=lambda st: st.timestamp)
+    if last_state_transition is not None:
+        state = last_state_transition.final
+    else:
+        state = system_states.SystemState.ON
+    event = get_drain_detector().update(
+        int(time.time()),
+        info,
+        get_backlight_source().last_percentage,
+        state,
+        proc_stats,
+    )
+    if event is not None:
+        get_sink().insert_anomaly(event)
 
 
 @app.command()
@@ -68,9 +163,19 @@ def updater(
         60, "--interval", "-i", help="Update interval (in seconds)"
     ),
 ):
-    while True:
-        update_all()
-        time.sleep(interval)
+    global buffered_writer
+    # Exit normally on SIGTERM (e.g. systemctl stop) so that queued samples
+    # are written before the daemon writer thread is killed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    buffered_writer = writer.BufferedWriter(get_database())
+    buffered_writer.start()
+    try:
+        while True:
+            update_all()
+            time.sleep(interval)
+    finally:
+        buffered_writer.close()
+        buffered_writer = None
 
 
 @app.command()
@@ -116,5 +221,145 @@ def true_power():
     console.print(Text(f"True power estimate: {est}"))
 
 
+@app.command(name="watch")
+def watch_status(
+    interval: float = typer.Option(
+        1.0, "--interval", "-i", help="Refresh interval (in seconds)"
+    ),
+    top: int = typer.Option(10, "--top", "-n", help="Number of top processes"),
+):
+    tracker = watch.PowerTracker()
+    sampler = proc.ProcessCpuSampler()
+    try:
+        with Live(console=console, auto_refresh=False) as live:
+            while True:
+                info = tracker.read()
+                usage = sampler.sample()
+                live.update(watch.render(tracker, info, usage, top), refresh=True)
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tracker.close()
+        sampler.close()
+
+
+@app.command()
+def fleet_report(
+    directory: Path = typer.Argument(help="Directory containing batt databases"),
+    pattern: str = typer.Option(
+        "*.db", "--pattern", "-p", help="Glob pattern matching database files"
+    ),
+    workers: int = typer.Option(
+        None, "--workers", "-w", help="Number of worker processes"
+    ),
+    top: int = typer.Option(10, "--top", "-n", help="Number of top processes"),
+    use_cache: bool = typer.Option(
+        True, "--cache/--no-cache", help="Reuse results of unchanged databases"
+    ),
+    cache_path: Path = typer.Option(
+        fleet.FLEET_CACHE_PATH, "--cache-path", help="File to cache results in"
+    ),
+):
+    paths = sorted(directory.glob(pattern))
+    summary_cache = fleet.SummaryCache(cache_path if use_cache else None)
+
+    with Progress(console=console, transient=True) as progress:
+        task = progress.add_task("Summarizing databases", total=len(paths))
+
+        def on_result(path, summary, error):
+            if error is not None:
+                progress.console.print(
+                    Text(f"Skipping {path.name}: {error}", style="yellow")
+                )
+            progress.advance(task)
+
+        summary = fleet.summarize_fleet(paths, summary_cache, workers, on_result)
+
+    try:
+        summary_cache.save()
+    except OSError as e:
+        console.print(Text(f"Could not save result cache: {e}", style="yellow"))
+
+    console.print(Text(f"Summarized {len(paths)} databases"))
+    print_summary(summary, top)
+
+
+@app.command()
+def report(
+    days: int = typer.Option(
+        14, "--days", "-d", help="Number of days of discharge power to show"
+    ),
+    top: int = typer.Option(10, "--top", "-n", help="Number of top processes"),
+):
+    database = get_database()
+    print_summary(batt_report.cached_summary(database), top)
+
+    daily = batt_report.cached_discharge_power_by_bucket(database, 86400)
+    table = Table(title="Average discharge power by day (UTC)")
+    table.add_column("Day")
+    table.add_column("Power", justify="right")
+    for day in sorted(daily)[-days:]:
+        total, count = daily[day]
+        # Buckets are whole days since the epoch, i.e. UTC days
+        date = datetime.fromtimestamp(day, timezone.utc).date().isoformat()
+        table.add_row(date, f"{total / count / 1000:.01f}W")
+    console.print(table)
+
+
+@app.command()
+def power_model(
+    rebuild: bool = typer.Option(
+        False, "--rebuild", help="Refit the model from all recorded samples"
+    ),
+):
+    fitted = model.update_power_model(get_database(), rebuild)
+    if (attribution := fitted.attribution()) is None:
+        console.print(
+            Text(
+                f"Not enough variation in {fitted.count} samples to fit the model",
+                style="yellow",
+            )
+        )
+        return
+
+    baseline, per_percent, per_core = fitted.coefficients()
+    _, backlight_mean, cpu_mean = fitted.means
+    table = Table(title=f"Average discharge power over {fitted.count} samples")
+    table.add_column("Source")
+    table.add_column("Power", justify="right")
+    table.add_column("Marginal", justify="right")
+    table.add_row("Baseline", f"{attribution['baseline'] / 1000:.02f}W", "")
+    table.add_row(
+        f"Backlight (average {backlight_mean:.0f}%)",
+        f"{attribution['backlight'] / 1000:.02f}W",
+        f"{per_percent * 10 / 1000:.02f}W per 10%",
+    )
+    table.add_row(
+        f"CPU (average {cpu_mean:.02f} cores)",
+        f"{attribution['cpu'] / 1000:.02f}W",
+        f"{per_core / 1000:.02f}W per core",
+    )
+    console.print(table)
+
+
+def print_summary(summary: batt_report.Summary, top: int):
+    table = Table(show_header=False, box=None)
+    table.add_column("Item", style="grey70")
+    table.add_column("Value", justify="right", style="bold")
+    if (power := summary.average_discharge_power) is not None:
+        table.add_row("Average discharge power", f"{power / 1000:.01f}W")
+    if (drain := summary.sleep_drain) is not None:
+        table.add_row("Average sleep drain", f"{drain / 1000:.02f}W")
+    console.print(table)
+
+    processes = Table(title="Top processes by CPU time")
+    processes.add_column("Process")
+    processes.add_column("CPU ticks", justify="right")
+    for name, ticks in summary.top_processes(top):
+        processes.add_row(name, str(ticks))
+    console.print(processes)
+
+
 if __name__ == "__main__":
     app()
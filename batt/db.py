@@ -1,16 +1,24 @@
+import json
 import os
 import sqlite3
+import threading
+import time
+import weakref
 from dataclasses import dataclass
 from contextlib import contextmanager
 from pathlib import Path
 from typing import Literal
 
+from batt.anomaly import Anomaly
 from batt.backlight import BacklightReading
 from batt.psu import BatteryInfo
 from batt.system_states import StateTransition
 from batt.proc import ProcessStat
 
 BATT_DB_PATH = Path(os.environ.get("BATT_DB_PATH", Path.home() / ".batt.db"))
+# A cached report's last use is only rewritten once it is older than this
+# (in nanoseconds), so that cache hits rarely need a write
+REPORT_LAST_USED_RESOLUTION = 3600 * 10**9
 
 
 @dataclass
@@ -38,6 +46,9 @@ class Table:
     name: str
     columns: tuple[Column, ...]
     additional_statements: str = ""
+    indexes: tuple[tuple[str, ...], ...] = ()
+    # Rows are only ever inserted with increasing rowids and never deleted
+    append_only: bool = False
 
     @property
     def create_statement(self) -> str:
@@ -46,6 +57,82 @@ class Table:
             column_stmnts = f"{column_stmnts}, {self.additional_statements}"
         return f"CREATE TABLE IF NOT EXISTS {self.name} ({column_stmnts})"
 
+    @property
+    def index_statements(self) -> list[str]:
+        return [
+            f"CREATE INDEX IF NOT EXISTS {self.name}_{'_'.join(columns)}_idx "
+            f"ON {self.name} ({', '.join(columns)})"
+            for columns in self.indexes
+        ]
+
+
+class _ThreadReader:
+    """Holds a thread's reader connection in its thread-local storage, which
+    is dropped when the thread exits"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+
+def _release_reader(
+    readers: set[sqlite3.Connection], lock: threading.Lock, conn: sqlite3.Connection
+):
+    with lock:
+        readers.discard(conn)
+    conn.close()
+
+
+class ConnectionManager:
+    """Hands out connections to a SQLite database for concurrent use.
+
+    There is a single writer connection, shared between threads and
+    serialized by a lock, and a pool of read-only connections with one
+    connection per thread, closed when its thread exits. The database is put
+    in WAL mode so that readers do not block the writer (or vice versa)."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.write_lock = threading.RLock()
+        self.writer = sqlite3.connect(self.path, check_same_thread=False)
+        self.writer.execute("PRAGMA journal_mode = WAL")
+        self._local = threading.local()
+        self._readers: set[sqlite3.Connection] = set()
+        self._readers_lock = threading.Lock()
+
+    @property
+    def reader(self) -> sqlite3.Connection:
+        """Read-only connection owned by the calling thread"""
+        if (handle := getattr(self._local, "reader", None)) is None:
+            handle = _ThreadReader(connect_read_only(self.path))
+            # Not a bound method, which would keep the manager alive
+            weakref.finalize(
+                handle, _release_reader, self._readers, self._readers_lock, handle.conn
+            )
+            self._local.reader = handle
+            with self._readers_lock:
+                self._readers.add(handle.conn)
+        return handle.conn
+
+    def close(self):
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+        with self.write_lock:
+            self.writer.close()
+
+
+def connect_read_only(path: Path, immutable: bool = False) -> sqlite3.Connection:
+    """Open a read-only connection to the database at path. An immutable
+    database is assumed not to change while it is open, so SQLite neither
+    locks it nor creates -wal/-shm files, which allows reading databases in
+    read-only directories."""
+    # as_uri() percent-encodes characters such as # and ? in the path
+    uri = f"{Path(path).absolute().as_uri()}?mode=ro"
+    if immutable:
+        uri = f"{uri}&immutable=1"
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
 
 class Database:
     BATTERY_INFO_TABLE = Table(
@@ -87,30 +174,75 @@ class Database:
             Column("backlight_percentage", "INTEGER"),
         ),
     )
+    PROCESS_IDENTITY_TABLE = Table(
+        "process_identity",
+        (
+            Column("id", "INTEGER", primary_key=True, autoincrement=True),
+            Column("pid", "INTEGER"),
+            Column("start_time", "INTEGER"),
+            Column("name", "TEXT"),
+            Column("ppid", "INTEGER"),
+        ),
+        additional_statements="UNIQUE(pid, start_time, name)",
+        append_only=True,
+    )
     PROC_STATUS_TABLE = Table(
         "proc_status",
         (
             Column("timestamp", "INTEGER"),
-            Column("pid", "INTEGER"),
-            Column("ppid", "INTEGER"),
-            Column("name", "TEXT"),
+            Column("identity_id", "INTEGER"),
             Column("utime", "INTEGER"),
             Column("stime", "INTEGER"),
             Column("cutime", "INTEGER"),
             Column("cstime", "INTEGER"),
         ),
+        additional_statements=f"FOREIGN KEY(identity_id) REFERENCES {PROCESS_IDENTITY_TABLE.name}(id)",
+        indexes=(("timestamp",),),
+        append_only=True,
+    )
+    REPORT_CACHE_TABLE = Table(
+        "report_cache",
+        (
+            Column("name", "TEXT"),
+            Column("params", "TEXT"),
+            Column("watermark", "TEXT"),
+            Column("result", "TEXT"),
+            Column("size", "INTEGER"),
+            Column("last_used", "INTEGER"),
+        ),
+        additional_statements="PRIMARY KEY(name, params)",
+    )
+    ANOMALIES_TABLE = Table(
+        "anomalies",
+        (
+            Column("start_timestamp", "INTEGER", primary_key=True),
+            Column("end_timestamp", "INTEGER"),
+            Column("peak_power", "INTEGER"),
+            Column("expected_power", "INTEGER"),
+            Column("backlight_percentage", "INTEGER"),
+            Column("system_state", "INTEGER"),
+            Column("top_processes", "TEXT"),
+        ),
     )
     TABLES = (
         BATTERY_INFO_TABLE,
         STATUS_TABLE,
         SYSTEM_STATES_TABLE,
         BACKLIGHT_TABLE,
+        PROCESS_IDENTITY_TABLE,
         PROC_STATUS_TABLE,
+        REPORT_CACHE_TABLE,
+        ANOMALIES_TABLE,
     )
 
     def __init__(self, path: Path):
         self.path = path
-        self.conn = sqlite3.connect(self.path)
+        self.connections = ConnectionManager(self.path)
+        self.conn = self.connections.writer
+        self._write_depth = 0
+        # Maps (pid, start_time, name) to process_identity.id so that the
+        # identity lookup is only done once per process
+        self.process_identity_cache: dict[tuple[int, int, str], int] = {}
         self.initialize_tables()
 
     @classmethod
@@ -119,25 +251,112 @@ class Database:
 
     @contextmanager
     def cursor(self):
-        cursor = self.conn.cursor()
+        """Cursor on the writer connection, holding the write lock"""
+        with self.connections.write_lock:
+            cursor = self.conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def read_cursor(self):
+        """Cursor on the calling thread's read-only connection"""
+        cursor = self.connections.reader.cursor()
         try:
             yield cursor
         finally:
             cursor.close()
 
+    @contextmanager
+    def write(self):
+        """Cursor on the writer connection. Changes are committed when the
+        outermost write block exits and rolled back if it raises"""
+        with self.connections.write_lock:
+            self._write_depth += 1
+            try:
+                with self.cursor() as cursor:
+                    yield cursor
+            except BaseException:
+                if self._write_depth == 1:
+                    self.conn.rollback()
+                    # Cached identities may refer to rolled back rows
+                    self.process_identity_cache.clear()
+                raise
+            else:
+                if self._write_depth == 1:
+                    self.conn.commit()
+            finally:
+                self._write_depth -= 1
+
+    def close(self):
+        self.connections.close()
+
     def initialize_tables(self):
-        with self.cursor() as cur:
+        legacy_proc_status = self.has_legacy_proc_status_table()
+        with self.write() as cur:
+            # sqlite3 does not open a transaction for DDL statements, so one
+            # is opened explicitly to make the migration all or nothing
+            cur.execute("BEGIN")
+            if legacy_proc_status:
+                cur.execute(
+                    f"ALTER TABLE {self.PROC_STATUS_TABLE.name} "
+                    f"RENAME TO {self.PROC_STATUS_TABLE.name}_legacy"
+                )
             for table in Database.TABLES:
                 cur.execute(table.create_statement)
+                for index_statement in table.index_statements:
+                    cur.execute(index_statement)
+            if legacy_proc_status or self.has_interrupted_migration():
+                self.migrate_legacy_proc_status()
+
+    def has_legacy_proc_status_table(self) -> bool:
+        """Older databases stored the process name and pid in every
+        proc_status row instead of referencing a process_identity"""
+        with self.cursor() as cur:
+            cur.execute(f"PRAGMA table_info({self.PROC_STATUS_TABLE.name})")
+            column_names = {row[1] for row in cur.fetchall()}
+        return "name" in column_names
+
+    def has_interrupted_migration(self) -> bool:
+        """Whether a renamed legacy proc_status table was left behind by a
+        migration that did not finish"""
+        with self.cursor() as cur:
+            cur.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                (f"{self.PROC_STATUS_TABLE.name}_legacy",),
+            )
+            return cur.fetchone() is not None
+
+    def migrate_legacy_proc_status(self):
+        """Move rows from the legacy proc_status table into the
+        process_identity + proc_status tables. Process start times were
+        not recorded, so migrated identities use a start_time of 0"""
+        legacy = f"{self.PROC_STATUS_TABLE.name}_legacy"
+        identity = self.PROCESS_IDENTITY_TABLE.name
+        with self.cursor() as cur:
+            cur.execute(
+                f"INSERT OR IGNORE INTO {identity} (pid, start_time, name, ppid) "
+                f"SELECT pid, 0, name, MIN(ppid) FROM {legacy} GROUP BY pid, name"
+            )
+            cur.execute(
+                f"INSERT INTO {self.PROC_STATUS_TABLE.name} "
+                f"(timestamp, identity_id, utime, stime, cutime, cstime) "
+                f"SELECT l.timestamp, i.id, l.utime, l.stime, l.cutime, l.cstime "
+                f"FROM {legacy} l JOIN {identity} i "
+                f"ON i.pid = l.pid AND i.start_time = 0 AND i.name = l.name"
+            )
+            cur.execute(f"DROP TABLE {legacy}")
 
     def turn_on_foreign_keys(self):
         with self.cursor() as cur:
             cur.execute("PRAGMA foreign_keys = ON")
 
     def insert_battery_status(self, info: BatteryInfo, timestamp: int):
-        if (info_id := self.get_existing_battery_info_id(info)) is None:
-            self.insert_battery_info(info)
-            info_id = self.get_existing_battery_info_id(info)
+        with self.write():
+            if (info_id := self.get_existing_battery_info_id(info)) is None:
+                self.insert_battery_info(info)
+                info_id = self.get_existing_battery_info_id(info)
 
         column_names = [col.name for col in self.STATUS_TABLE.columns]
         values = [
@@ -151,13 +370,14 @@ class Database:
             info.energy_now // 1000,
         ]
         placeholders = ", ".join("?" * len(values))
+        # Ignore samples that were already written, e.g. when replaying
+        # spooled samples
         insert_stmt = (
-            f"INSERT INTO {self.STATUS_TABLE.name} "
+            f"INSERT OR IGNORE INTO {self.STATUS_TABLE.name} "
             f"({','.join(column_names)}) VALUES ({placeholders})"
         )
-        with self.cursor() as cursor:
+        with self.write() as cursor:
             cursor.execute(insert_stmt, values)
-        self.conn.commit()
 
     def get_existing_battery_info_id(self, info: BatteryInfo) -> int | None:
         """Assume that two batteries are the same if they have
@@ -191,37 +411,37 @@ class Database:
             f"INSERT INTO {self.BATTERY_INFO_TABLE.name} "
             f"({','.join(column_names)}) VALUES ({placeholders})"
         )
-        with self.cursor() as cursor:
+        with self.write() as cursor:
             cursor.execute(insert_stmt, values)
-        self.conn.commit()
 
     def insert_state_transition(self, st: StateTransition):
         column_names = [col.name for col in self.SYSTEM_STATES_TABLE.columns]
         values = [st.timestamp, st.initial.value, st.final.value]
         placeholders = ", ".join("?" * len(values))
+        # Transitions are re-read from the journal, so ones that were
+        # already recorded are ignored
         insert_stmt = (
-            f"INSERT INTO {self.SYSTEM_STATES_TABLE.name} "
+            f"INSERT OR IGNORE INTO {self.SYSTEM_STATES_TABLE.name} "
             f"({','.join(column_names)}) VALUES ({placeholders})"
         )
-        with self.cursor() as cursor:
+        with self.write() as cursor:
             cursor.execute(insert_stmt, values)
-        self.conn.commit()
 
     def insert_backlight_reading(self, br: BacklightReading):
         column_names = [col.name for col in self.BACKLIGHT_TABLE.columns]
         values = [br.timestamp, br.brightness_percentage]
         placeholders = ", ".join("?" * len(values))
+        # Only the last of several changes within the same second is kept
         insert_stmt = (
-            f"INSERT INTO {self.BACKLIGHT_TABLE.name} "
+            f"INSERT OR REPLACE INTO {self.BACKLIGHT_TABLE.name} "
             f"({','.join(column_names)}) VALUES ({placeholders})"
         )
-        with self.cursor() as cursor:
+        with self.write() as cursor:
             cursor.execute(insert_stmt, values)
-        self.conn.commit()
 
     def most_recent_system_state(self) -> StateTransition | None:
         query = f"SELECT * FROM {self.SYSTEM_STATES_TABLE.name} ORDER BY timestamp desc"
-        with self.cursor() as cursor:
+        with self.read_cursor() as cursor:
             cursor.execute(query)
             res = cursor.fetchone()
             if res:
@@ -229,13 +449,56 @@ class Database:
 
         return res
 
+    def get_process_identity_id(self, proc: ProcessStat) -> int:
+        """Returns the process_identity id for a process, inserting a new
+        identity the first time a process is seen"""
+        if (identity_id := self.process_identity_cache.get(proc.identity)) is not None:
+            return identity_id
+
+        stmt = (
+            f"SELECT id FROM {self.PROCESS_IDENTITY_TABLE.name} WHERE "
+            f"pid = ? AND start_time = ? AND name = ?"
+        )
+        with self.write() as cur:
+            cur.execute(stmt, proc.identity)
+            if result := cur.fetchone():
+                identity_id = result[0]
+            else:
+                cur.execute(
+                    f"INSERT INTO {self.PROCESS_IDENTITY_TABLE.name} "
+                    f"(pid, start_time, name, ppid) VALUES (?, ?, ?, ?)",
+                    (*proc.identity, proc.ppid),
+                )
+                identity_id = cur.lastrowid
+        self.process_identity_cache[proc.identity] = identity_id
+        return identity_id
+
+    def prune_process_identity_cache(self, live: list[ProcessStat]):
+        """Drop cached identities of processes that are no longer running"""
+        live_identities = {proc.identity for proc in live}
+        self.process_identity_cache = {
+            identity: identity_id
+            for identity, identity_id in self.process_identity_cache.items()
+            if identity in live_identities
+        }
+
+    def most_recent_backlight_reading(self) -> BacklightReading | None:
+        query = (
+            f"SELECT timestamp, backlight_percentage FROM {self.BACKLIGHT_TABLE.name} "
+            f"ORDER BY timestamp desc"
+        )
+        with self.read_cursor() as cursor:
+            cursor.execute(query)
+            if res := cursor.fetchone():
+                return BacklightReading(*res)
+
+        return None
+
     def insert_process_stat(self, proc: ProcessStat):
         column_names = [col.name for col in self.PROC_STATUS_TABLE.columns]
         values = [
             proc.timestamp,
-            proc.pid,
-            proc.ppid,
-            proc.command,
+            self.get_process_identity_id(proc),
             proc.utime,
             proc.stime,
             proc.cutime,
@@ -246,6 +509,100 @@ class Database:
             f"INSERT INTO {self.PROC_STATUS_TABLE.name} "
             f"({','.join(column_names)}) VALUES ({placeholders})"
         )
-        with self.cursor() as cursor:
+        with self.write() as cursor:
+            cursor.execute(insert_stmt, values)
+
+    def insert_anomaly(self, anomaly: Anomaly):
+        column_names = [col.name for col in self.ANOMALIES_TABLE.columns]
+        values = [
+            anomaly.start_timestamp,
+            anomaly.end_timestamp,
+            anomaly.peak_power,
+            anomaly.expected_power,
+            anomaly.backlight_percentage,
+            anomaly.system_state.value,
+            anomaly.top_processes,
+        ]
+        placeholders = ", ".join("?" * len(values))
+        # An ongoing anomaly is rewritten as it is extended
+        insert_stmt = (
+            f"INSERT OR REPLACE INTO {self.ANOMALIES_TABLE.name} "
+            f"({','.join(column_names)}) VALUES ({placeholders})"
+        )
+        with self.write() as cursor:
+            cursor.execute(insert_stmt, values)
+
+    def table_watermarks(self, tables: list[str]) -> dict[str, list[int]]:
+        """Values that change whenever rows are added to each table: the
+        largest rowid of append-only tables, which is a single index lookup,
+        and the largest rowid and row count of other tables, where rows
+        keyed by timestamp may be inserted late below the largest rowid"""
+        append_only = {table.name for table in self.TABLES if table.append_only}
+        watermarks = {}
+        with self.read_cursor() as cursor:
+            for table in tables:
+                if table in append_only:
+                    cursor.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM {table}")
+                else:
+                    cursor.execute(
+                        f"SELECT COALESCE(MAX(rowid), 0), COUNT(*) FROM {table}"
+                    )
+                watermarks[table] = list(cursor.fetchone())
+        return watermarks
+
+    def get_cached_report(self, name: str, params: dict) -> tuple[dict, object] | None:
+        """Watermark and result of a cached report, if there is one"""
+        key = (name, json.dumps(params, sort_keys=True))
+        query = (
+            f"SELECT watermark, result, last_used FROM {self.REPORT_CACHE_TABLE.name} "
+            f"WHERE name = ? AND params = ?"
+        )
+        with self.read_cursor() as cursor:
+            cursor.execute(query, key)
+            if (res := cursor.fetchone()) is None:
+                return None
+        watermark, result, last_used = res
+        if (now := time.time_ns()) - last_used > REPORT_LAST_USED_RESOLUTION:
+            with self.write() as cursor:
+                cursor.execute(
+                    f"UPDATE {self.REPORT_CACHE_TABLE.name} SET last_used = ? "
+                    f"WHERE name = ? AND params = ?",
+                    (now, *key),
+                )
+        return json.loads(watermark), json.loads(result)
+
+    def put_cached_report(
+        self, name: str, params: dict, watermark: dict, result, max_size: int
+    ):
+        """Cache a report result, evicting the least recently used results
+        once the cached results exceed max_size bytes"""
+        result_json = json.dumps(result)
+        values = [
+            name,
+            json.dumps(params, sort_keys=True),
+            json.dumps(watermark),
+            result_json,
+            len(result_json),
+            time.time_ns(),
+        ]
+        placeholders = ", ".join("?" * len(values))
+        insert_stmt = (
+            f"INSERT OR REPLACE INTO {self.REPORT_CACHE_TABLE.name} "
+            f"VALUES ({placeholders})"
+        )
+        with self.write() as cursor:
             cursor.execute(insert_stmt, values)
-        self.conn.commit()
+            cursor.execute(
+                f"SELECT name, params, size FROM {self.REPORT_CACHE_TABLE.name} "
+                f"ORDER BY last_used DESC"
+            )
+            total, evicted = 0, []
+            for cached_name, cached_params, size in cursor.fetchall():
+                total += size
+                if total > max_size:
+                    evicted.append((cached_name, cached_params))
+            cursor.executemany(
+                f"DELETE FROM {self.REPORT_CACHE_TABLE.name} "
+                f"WHERE name = ? AND params = ?",
+                evicted,
+            )
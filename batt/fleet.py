@@ -0,0 +1,118 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict
+from pathlib import Path
+from typing import Callable, Iterable
+
+import batt.report as report
+from batt.db import connect_read_only
+
+FLEET_CACHE_PATH = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    / "batt"
+    / "fleet-cache.json"
+)
+
+
+def file_signature(path: Path) -> list[int]:
+    """Modification time and size of a database, including its WAL file if
+    present, used to tell whether a database changed since it was last
+    summarized"""
+    signature = []
+    for file in (path, path.with_name(f"{path.name}-wal")):
+        if file.exists():
+            stat = file.stat()
+            signature.extend((stat.st_mtime_ns, stat.st_size))
+    return signature
+
+
+class SummaryCache:
+    """Summaries of databases stored in a JSON file, keyed by database path
+    and only valid while the file signature of the database is unchanged"""
+
+    def __init__(self, path: Path | None):
+        self.path = path
+        self.entries: dict[str, dict] = {}
+        if path is not None and path.exists():
+            try:
+                self.entries = json.loads(path.read_text())
+            except (OSError, json.JSONDecodeError):
+                self.entries = {}
+
+    def get(self, db_path: Path) -> report.Summary | None:
+        entry = self.entries.get(str(db_path.absolute()))
+        if entry is not None and entry["signature"] == file_signature(db_path):
+            return report.Summary(**entry["summary"])
+
+    def put(self, db_path: Path, signature: list[int], summary: report.Summary):
+        """Store a summary under the signature the database had before it was
+        summarized, so that changes made while summarizing invalidate it"""
+        self.entries[str(db_path.absolute())] = {
+            "signature": signature,
+            "summary": asdict(summary),
+        }
+
+    def save(self):
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f"{self.path.name}.tmp")
+            tmp.write_text(json.dumps(self.entries))
+            tmp.replace(self.path)
+
+
+def summarize_database(path: Path) -> report.Summary:
+    """Summarize a single database, opened read-only as an immutable
+    snapshot so that nothing is written next to collected databases"""
+    conn = connect_read_only(path, immutable=True)
+    try:
+        return report.summarize(conn)
+    finally:
+        conn.close()
+
+
+def summarize_fleet(
+    paths: Iterable[Path],
+    cache: SummaryCache,
+    max_workers: int | None = None,
+    on_result: Callable[[Path, report.Summary | None, Exception | None], None]
+    | None = None,
+) -> report.Summary:
+    """Summarize many databases in parallel and merge the results.
+
+    Databases with an up to date entry in the cache are not reopened. New
+    summaries are added to the cache, which is left to the caller to save.
+    on_result is called as each database finishes, with either its summary
+    or the exception raised while summarizing it."""
+
+    def notify(path, summary, error=None):
+        if on_result is not None:
+            on_result(path, summary, error)
+
+    total = report.Summary()
+    pending = []
+    for path in paths:
+        if (summary := cache.get(path)) is not None:
+            total = total.merge(summary)
+            notify(path, summary)
+        else:
+            pending.append(path)
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for path in pending:
+                signature = file_signature(path)
+                futures[executor.submit(summarize_database, path)] = (path, signature)
+            for future in as_completed(futures):
+                path, signature = futures[future]
+                try:
+                    summary = future.result()
+                except Exception as e:
+                    notify(path, None, e)
+                    continue
+                cache.put(path, signature, summary)
+                total = total.merge(summary)
+                notify(path, summary)
+
+    return total
@@ -0,0 +1,176 @@
+import sqlite3
+from bisect import bisect_left, bisect_right
+from dataclasses import asdict, dataclass, field
+
+from batt.db import Database
+from batt.proc import CLK_TCK
+from batt.psu import LowLevelBatteryStatus
+from batt.report import REPORT_CACHE_MAX_SIZE
+
+# Maximum time (in seconds) between process samples for the CPU ticks used
+# between them to count as load, e.g. not across a sleep
+MAX_TICK_GAP = 300
+# Maximum time (in seconds) between a process sample and the status sample
+# it is paired with
+ALIGNMENT_TOLERANCE = 30
+# Number of features: baseline, backlight percentage, CPU load
+FEATURES = 3
+
+
+@dataclass
+class AlignedSample:
+    timestamp: int
+    backlight_percentage: int
+    cpu_load: float
+    power: int
+
+
+@dataclass
+class PowerModel:
+    """Linear model of discharge power (in mW) as
+
+    power = baseline + backlight * backlight_percentage + cpu * cpu_load
+
+    where cpu_load is the number of busy cores. The normal equations are kept
+    as running sums so that new samples are added without revisiting old
+    ones. last_timestamp is the last process sample that has been added."""
+
+    count: int = 0
+    xtx: list[list[float]] = field(
+        default_factory=lambda: [[0.0] * FEATURES for _ in range(FEATURES)]
+    )
+    xty: list[float] = field(default_factory=lambda: [0.0] * FEATURES)
+    last_timestamp: int = 0
+
+    def add(self, sample: AlignedSample):
+        x = (1.0, sample.backlight_percentage, sample.cpu_load)
+        for i in range(FEATURES):
+            for j in range(FEATURES):
+                self.xtx[i][j] += x[i] * x[j]
+            self.xty[i] += x[i] * sample.power
+        self.count += 1
+
+    def coefficients(self) -> list[float] | None:
+        """Least squares (baseline, backlight, cpu) coefficients, or None if
+        they are not identifiable, e.g. the backlight never changed"""
+        a = [row[:] + [y] for row, y in zip(self.xtx, self.xty)]
+        n = len(a)
+        for col in range(n):
+            pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+            if abs(a[pivot][col]) <= 1e-9 * max(1.0, abs(self.xtx[col][col])):
+                return None
+            a[col], a[pivot] = a[pivot], a[col]
+            for r in range(n):
+                if r != col:
+                    factor = a[r][col] / a[col][col]
+                    a[r] = [v - factor * p for v, p in zip(a[r], a[col])]
+        return [a[i][n] / a[i][i] for i in range(n)]
+
+    @property
+    def means(self) -> list[float]:
+        """Mean of each feature (the first, constant feature is 1)"""
+        return [total / self.count for total in self.xtx[0]]
+
+    def attribution(self) -> dict[str, float] | None:
+        """Average power (in mW) attributable to each term of the model"""
+        if not self.count or (coefs := self.coefficients()) is None:
+            return None
+        names = ("baseline", "backlight", "cpu")
+        return {name: c * m for name, c, m in zip(names, coefs, self.means)}
+
+
+def cpu_load_by_tick(conn: sqlite3.Connection, since: int) -> list[tuple[int, float]]:
+    """Busy cores between each process sample after since and the sample
+    before it, from the CPU ticks used by processes present in both"""
+    cur = conn.execute(
+        "SELECT timestamp, MAX(prev_timestamp), SUM(ticks - prev_ticks) FROM ("
+        "  SELECT timestamp, utime + stime AS ticks,"
+        "    LAG(utime + stime) OVER w AS prev_ticks,"
+        "    LAG(timestamp) OVER w AS prev_timestamp"
+        "  FROM proc_status WHERE timestamp >= ?"
+        "  WINDOW w AS (PARTITION BY identity_id ORDER BY timestamp)"
+        ") WHERE prev_ticks IS NOT NULL GROUP BY timestamp ORDER BY timestamp",
+        (since,),
+    )
+    return [
+        (ts, ticks / (CLK_TCK * (ts - prev_ts)))
+        for ts, prev_ts, ticks in cur
+        if 0 < ts - prev_ts <= MAX_TICK_GAP
+    ]
+
+
+def aligned_samples(
+    conn: sqlite3.Connection, since: int, until: int
+) -> list[AlignedSample]:
+    """Backlight, CPU load and discharge power on the grid of process
+    samples in (since, until). Backlight is the last recorded value and
+    power is the nearest discharging status sample."""
+    loads = [(ts, load) for ts, load in cpu_load_by_tick(conn, since) if ts < until]
+    if not loads:
+        return []
+    start, end = loads[0][0], loads[-1][0]
+
+    status = conn.execute(
+        "SELECT timestamp, power FROM status "
+        "WHERE status = ? AND timestamp BETWEEN ? AND ? ORDER BY timestamp",
+        (
+            LowLevelBatteryStatus.Discharging.value,
+            start - ALIGNMENT_TOLERANCE,
+            end + ALIGNMENT_TOLERANCE,
+        ),
+    ).fetchall()
+    backlight = conn.execute(
+        "SELECT timestamp, backlight_percentage FROM backlight WHERE timestamp >= "
+        "(SELECT COALESCE(MAX(timestamp), 0) FROM backlight WHERE timestamp <= ?) "
+        "AND timestamp <= ? ORDER BY timestamp",
+        (start, end),
+    ).fetchall()
+    status_ts = [ts for ts, _ in status]
+    backlight_ts = [ts for ts, _ in backlight]
+
+    samples = []
+    for ts, load in loads:
+        if (b := bisect_right(backlight_ts, ts)) == 0:
+            continue
+        i = bisect_left(status_ts, ts)
+        nearest = min(
+            (c for c in (i - 1, i) if 0 <= c < len(status)),
+            key=lambda c: abs(status_ts[c] - ts),
+            default=None,
+        )
+        if nearest is None or abs(status_ts[nearest] - ts) > ALIGNMENT_TOLERANCE:
+            continue
+        samples.append(AlignedSample(ts, backlight[b - 1][1], load, status[nearest][1]))
+    return samples
+
+
+def update_power_model(database: Database, rebuild: bool = False) -> PowerModel:
+    """Add process samples recorded since the model was last updated. The
+    model is kept in the report cache."""
+    name, params = "power_model", {}
+    model = PowerModel()
+    if not rebuild and (cached := database.get_cached_report(name, params)):
+        _, result = cached
+        model = PowerModel(**result)
+
+    conn = database.connections.reader
+    # The most recent process sample may still be being written
+    (until,) = conn.execute(
+        "SELECT COALESCE(MAX(timestamp), 0) FROM proc_status"
+    ).fetchone()
+    for sample in aligned_samples(conn, model.last_timestamp, until):
+        model.add(sample)
+    (last,) = conn.execute(
+        "SELECT COALESCE(MAX(timestamp), ?) FROM proc_status WHERE timestamp < ?",
+        (model.last_timestamp, until),
+    ).fetchone()
+    model.last_timestamp = last
+
+    database.put_cached_report(
+        name,
+        params,
+        {"last_timestamp": model.last_timestamp},
+        asdict(model),
+        REPORT_CACHE_MAX_SIZE,
+    )
+    return model
@@ -1,7 +1,11 @@
+import os
+import resource
 import time
 from dataclasses import dataclass
 from pathlib import Path
 
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
 
 @dataclass
 class ProcessStat:
@@ -13,6 +17,14 @@ class ProcessStat:
     stime: int
     cutime: int
     cstime: int
+    start_time: int
+
+    @property
+    def identity(self) -> tuple[int, int, str]:
+        """A process is uniquely identified by its pid, its start time (in
+        clock ticks after boot) and its command name, which distinguishes
+        processes that happen to reuse a pid"""
+        return self.pid, self.start_time, self.command
 
     @property
     def total(self) -> int:
@@ -29,15 +41,30 @@ def get_proc_pid_stat_files():
     return stat_files
 
 
+def split_stat(stat: bytes) -> tuple[int, str, list[bytes]]:
+    """Split the contents of a /proc/<pid>/stat file into the pid, the
+    command name and the remaining fields, starting from field 3 (state).
+    The command name may itself contain spaces and parentheses, so it is
+    taken to end at the last closing parenthesis."""
+    name_start, name_end = stat.find(b"(") + 1, stat.rfind(b")")
+    pid = int(stat[: name_start - 1])
+    name = stat[name_start:name_end].decode(errors="replace")
+    return pid, name, stat[name_end + 2 :].split()
+
+
 def parse_pid_stat_file(file: Path, timestamp: int) -> ProcessStat:
-    with open(file, "r") as f:
-        fields_str = f.read().strip()
-    name_start, name_end = fields_str.find(" (") + 1, fields_str.find(") ") + 1
-    name = fields_str[name_start:name_end].strip("()")
-    other_fields = fields_str.replace(name, "").split()
-    ppid = int(other_fields[3])
+    with open(file, "rb") as f:
+        pid, name, fields = split_stat(f.read())
+    # Field n of the stat file is at fields[n - 3]
+    ppid = int(fields[1])
+    start_time = int(fields[19])
     return ProcessStat(
-        timestamp, int(other_fields[0]), ppid, name, *map(int, other_fields[13:17])
+        timestamp,
+        pid,
+        ppid,
+        name,
+        *map(int, fields[11:15]),
+        start_time,
     )
 
 
@@ -46,3 +73,68 @@ def get_all_proc_stats() -> list[ProcessStat]:
     ts = int(time.time())
     all_proc_stats = [parse_pid_stat_file(file, ts) for file in files]
     return all_proc_stats
+
+
+def parse_cpu_ticks(stat: bytes) -> tuple[str, int]:
+    """Command name and user + system clock ticks from the contents of a
+    /proc/<pid>/stat file"""
+    _, name, fields = split_stat(stat)
+    return name, int(fields[11]) + int(fields[12])
+
+
+class ProcessCpuSampler:
+    """Samples CPU usage of all processes incrementally.
+
+    The stat file of each process is kept open between samples and re-read
+    with a single pread, and CPU ticks from the previous sample are kept to
+    compute per-process usage since the last sample."""
+
+    def __init__(self, proc_dir: str = "/proc"):
+        self.proc_dir = proc_dir
+        self.fds: dict[int, int] = {}
+        self.previous: dict[int, int] = {}
+        self.previous_time: float | None = None
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        self.max_open_fds = soft_limit // 2
+
+    def read_stat(self, pid: int) -> bytes:
+        if (fd := self.fds.get(pid)) is None:
+            fd = os.open(f"{self.proc_dir}/{pid}/stat", os.O_RDONLY)
+            if len(self.fds) >= self.max_open_fds:
+                try:
+                    return os.pread(fd, 1024, 0)
+                finally:
+                    os.close(fd)
+            self.fds[pid] = fd
+        return os.pread(fd, 1024, 0)
+
+    def sample(self) -> list[tuple[str, float]]:
+        """Command name and CPU usage (in cores) of every process since the
+        previous sample, highest first. The first sample has no usage."""
+        now = time.monotonic()
+        pids = {int(d) for d in os.listdir(self.proc_dir) if d.isdigit()}
+        for pid in self.fds.keys() - pids:
+            os.close(self.fds.pop(pid))
+
+        current = {}
+        usage = []
+        elapsed = None if self.previous_time is None else now - self.previous_time
+        for pid in pids:
+            try:
+                name, ticks = parse_cpu_ticks(self.read_stat(pid))
+            except (OSError, ValueError, IndexError):
+                if (fd := self.fds.pop(pid, None)) is not None:
+                    os.close(fd)
+                continue
+            current[pid] = ticks
+            if elapsed and (prior := self.previous.get(pid)) is not None:
+                usage.append((name, (ticks - prior) / (CLK_TCK * elapsed)))
+
+        self.previous = current
+        self.previous_time = now
+        return sorted(usage, key=lambda u: u[1], reverse=True)
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds.clear()
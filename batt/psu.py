@@ -76,17 +76,24 @@ class BatteryInfo:
     serial_number: str
 
 
+BAT0_PATH = Path("/sys/class/power_supply/BAT0/")
+
+
 def get_current_battery_info():
     """Parses /sys/class/power_supply/BAT0/uevent for current battery info"""
-    bat0_path = Path("/sys/class/power_supply/BAT0/")
+    with open(BAT0_PATH / "uevent", "r") as f:
+        return parse_uevent(f.read())
+
+
+def parse_uevent(contents: str) -> BatteryInfo:
+    """Parses the contents of a power supply uevent file"""
     parsed = {}
-    with open(bat0_path / "uevent", "r") as f:
-        for line in f:
-            if not line.startswith("POWER_SUPPLY"):
-                continue
-            key, val = line.split("=")
-            name = key.removeprefix("POWER_SUPPLY_")
-            parsed[name] = val.strip()
+    for line in contents.splitlines():
+        if not line.startswith("POWER_SUPPLY"):
+            continue
+        key, val = line.split("=")
+        name = key.removeprefix("POWER_SUPPLY_")
+        parsed[name] = val.strip()
 
     return BatteryInfo(
         name=parsed["NAME"],
@@ -120,3 +127,22 @@ def desmooth_power_reading(current: int, prior: int, alpha: float = 0.1365):
     experiments.
     """
     return (current - (1 - alpha) * prior) / alpha
+
+
+# Time (in seconds) between readings that the default smoothing parameter of
+# desmooth_power_reading was estimated for, as used by the true-power command
+DESMOOTH_INTERVAL = 10
+
+
+def smoothing_alpha(
+    elapsed: float, alpha: float = 0.1365, interval: float = DESMOOTH_INTERVAL
+) -> float:
+    """Smoothing parameter between two readings elapsed seconds apart, given
+    the smoothing parameter alpha for readings interval seconds apart.
+
+    Applying the smoothing k times while the true reading x stays constant
+    gives S[t+k] = (1 - (1 - alpha)^k) * x + (1 - alpha)^k * S[t], so
+    readings far apart are desmoothed with a larger alpha instead of
+    amplifying their difference as if they were a single step apart.
+    """
+    return 1 - (1 - alpha) ** (elapsed / interval)
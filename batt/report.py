@@ -0,0 +1,217 @@
+import sqlite3
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+
+from batt.db import Database
+from batt.psu import LowLevelBatteryStatus
+from batt.system_states import SystemState
+
+# Maximum distance (in seconds) between a sleep transition and the battery
+# status sample used as the energy reading before/after the sleep
+SLEEP_SAMPLE_TOLERANCE = 600
+
+# Maximum total size (in bytes of JSON) of cached report results
+REPORT_CACHE_MAX_SIZE = 1_000_000
+
+
+@dataclass
+class Summary:
+    """Aggregated battery statistics over one or more databases.
+
+    Only sums and counts are kept so that summaries of separate databases
+    can be merged into a summary over all of them. Units are milliwatts,
+    milliwatt-hours and seconds."""
+
+    discharge_power_total: int = 0
+    discharge_samples: int = 0
+    sleep_energy_drained: int = 0
+    sleep_seconds: int = 0
+    process_ticks: dict[str, int] = field(default_factory=dict)
+
+    def merge(self, other: "Summary") -> "Summary":
+        return Summary(
+            discharge_power_total=self.discharge_power_total
+            + other.discharge_power_total,
+            discharge_samples=self.discharge_samples + other.discharge_samples,
+            sleep_energy_drained=self.sleep_energy_drained
+            + other.sleep_energy_drained,
+            sleep_seconds=self.sleep_seconds + other.sleep_seconds,
+            process_ticks=dict(
+                Counter(self.process_ticks) + Counter(other.process_ticks)
+            ),
+        )
+
+    @property
+    def average_discharge_power(self) -> float | None:
+        """Average power (in mW) while discharging"""
+        if self.discharge_samples:
+            return self.discharge_power_total / self.discharge_samples
+
+    @property
+    def sleep_drain(self) -> float | None:
+        """Average power (in mW) drained while asleep"""
+        if self.sleep_seconds:
+            return 3600 * self.sleep_energy_drained / self.sleep_seconds
+
+    def top_processes(self, n: int = 10) -> list[tuple[str, int]]:
+        """Process names with the most CPU clock ticks"""
+        return Counter(self.process_ticks).most_common(n)
+
+
+def discharge_power(conn: sqlite3.Connection) -> tuple[int, int]:
+    """Sum and count of power readings (in mW) while discharging"""
+    cur = conn.execute(
+        "SELECT COALESCE(SUM(power), 0), COUNT(*) FROM status WHERE status = ?",
+        (LowLevelBatteryStatus.Discharging.value,),
+    )
+    return cur.fetchone()
+
+
+def sleep_intervals(conn: sqlite3.Connection) -> list[tuple[int, int]]:
+    """Start and end timestamps of every completed sleep"""
+    cur = conn.execute(
+        "SELECT timestamp, initial_state, final_state FROM system_state "
+        "ORDER BY timestamp"
+    )
+    intervals = []
+    start = None
+    for ts, initial, final in cur:
+        if final == SystemState.SLEEP.value:
+            start = ts
+        elif initial == SystemState.SLEEP.value and start is not None:
+            intervals.append((start, ts))
+            start = None
+    return intervals
+
+
+def sleep_drain(conn: sqlite3.Connection) -> tuple[int, int]:
+    """Energy drained (in mWh) and time elapsed (in seconds) across sleeps,
+    measured from the last status sample before each sleep to the first one
+    after it. Sleeps without nearby samples or during which the battery
+    charged are skipped."""
+    before_stmt = (
+        "SELECT timestamp, energy_now FROM status WHERE timestamp <= ? "
+        "ORDER BY timestamp DESC LIMIT 1"
+    )
+    after_stmt = (
+        "SELECT timestamp, energy_now FROM status WHERE timestamp >= ? "
+        "ORDER BY timestamp LIMIT 1"
+    )
+    drained, seconds = 0, 0
+    for start, end in sleep_intervals(conn):
+        before = conn.execute(before_stmt, (start,)).fetchone()
+        after = conn.execute(after_stmt, (end,)).fetchone()
+        if before is None or after is None:
+            continue
+        (before_ts, before_energy), (after_ts, after_energy) = before, after
+        if (
+            start - before_ts > SLEEP_SAMPLE_TOLERANCE
+            or after_ts - end > SLEEP_SAMPLE_TOLERANCE
+            or after_energy > before_energy
+        ):
+            continue
+        drained += before_energy - after_energy
+        seconds += after_ts - before_ts
+    return drained, seconds
+
+
+def process_ticks(conn: sqlite3.Connection) -> dict[str, int]:
+    """CPU clock ticks (user + system) used by each process name over the
+    sampled lifetime of its processes"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(proc_status)")}
+    if "identity_id" in columns:
+        per_process = (
+            "SELECT i.name AS name, "
+            "MAX(p.utime + p.stime) - MIN(p.utime + p.stime) AS ticks "
+            "FROM proc_status p JOIN process_identity i ON i.id = p.identity_id "
+            "GROUP BY p.identity_id"
+        )
+    else:
+        # Databases from before process identities were introduced
+        per_process = (
+            "SELECT name, MAX(utime + stime) - MIN(utime + stime) AS ticks "
+            "FROM proc_status GROUP BY pid, name"
+        )
+    cur = conn.execute(f"SELECT name, SUM(ticks) FROM ({per_process}) GROUP BY name")
+    return {name: ticks for name, ticks in cur if ticks}
+
+
+def summarize(conn: sqlite3.Connection) -> Summary:
+    power_total, power_samples = discharge_power(conn)
+    drained, slept = sleep_drain(conn)
+    return Summary(
+        discharge_power_total=power_total,
+        discharge_samples=power_samples,
+        sleep_energy_drained=drained,
+        sleep_seconds=slept,
+        process_ticks=process_ticks(conn),
+    )
+
+
+def discharge_power_by_bucket(
+    conn: sqlite3.Connection, bucket_seconds: int, since: int = 0
+) -> dict[int, tuple[int, int]]:
+    """Sum and count of power readings (in mW) while discharging in each
+    time bucket starting at or after since, keyed by bucket start time.
+    Buckets are aligned to the epoch, so daily buckets are UTC days."""
+    cur = conn.execute(
+        "SELECT (timestamp / ?) * ? AS bucket, SUM(power), COUNT(*) FROM status "
+        "WHERE status = ? AND timestamp >= ? GROUP BY bucket",
+        (
+            bucket_seconds,
+            bucket_seconds,
+            LowLevelBatteryStatus.Discharging.value,
+            since,
+        ),
+    )
+    return {bucket: (total, count) for bucket, total, count in cur}
+
+
+def cached_summary(database: Database) -> Summary:
+    """Summary of the database, recomputed only when its inputs changed"""
+    name, params = "summary", {}
+    tables = ["status", "system_state", "process_identity", "proc_status"]
+    watermark = database.table_watermarks(tables)
+    if (cached := database.get_cached_report(name, params)) is not None:
+        cached_watermark, result = cached
+        if cached_watermark == watermark:
+            return Summary(**result)
+
+    summary = summarize(database.connections.reader)
+    database.put_cached_report(
+        name, params, watermark, asdict(summary), REPORT_CACHE_MAX_SIZE
+    )
+    return summary
+
+
+def cached_discharge_power_by_bucket(
+    database: Database, bucket_seconds: int = 86400
+) -> dict[int, tuple[int, int]]:
+    """discharge_power_by_bucket over the whole database, cached.
+
+    status rows are keyed by timestamp, so when the only new rows are newer
+    than the cached watermark, only the buckets from the one containing the
+    watermark onwards are recomputed."""
+    name, params = "discharge_power_by_bucket", {"bucket_seconds": bucket_seconds}
+    conn = database.connections.reader
+    watermark = database.table_watermarks(["status"])
+    since = 0
+    buckets = {}
+    if (cached := database.get_cached_report(name, params)) is not None:
+        cached_watermark, result = cached
+        cached_buckets = {bucket: (total, count) for bucket, total, count in result}
+        if cached_watermark == watermark:
+            return cached_buckets
+        cached_max, cached_count = cached_watermark["status"]
+        _, count = watermark["status"]
+        (newer,) = conn.execute(
+            "SELECT COUNT(*) FROM status WHERE timestamp > ?", (cached_max,)
+        ).fetchone()
+        if cached_count + newer == count:
+            since = (cached_max // bucket_seconds) * bucket_seconds
+            buckets = {b: v for b, v in cached_buckets.items() if b < since}
+
+    buckets.update(discharge_power_by_bucket(conn, bucket_seconds, since))
+    result = [[bucket, total, count] for bucket, (total, count) in buckets.items()]
+    database.put_cached_report(name, params, watermark, result, REPORT_CACHE_MAX_SIZE)
+    return buckets
@@ -0,0 +1,85 @@
+import os
+import time
+from collections import deque
+from pathlib import Path
+
+from rich import box
+from rich.console import Group
+from rich.table import Table
+
+import batt.batt as batt
+import batt.psu as psu
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+
+def sparkline(values) -> str:
+    values = list(values)
+    if not values:
+        return ""
+    low, high = min(values), max(values)
+    span = (high - low) or 1
+    top = len(SPARK_CHARS) - 1
+    return "".join(SPARK_CHARS[round(top * (v - low) / span)] for v in values)
+
+
+class PowerTracker:
+    """Tracks battery power from an open uevent file.
+
+    The battery only updates its (smoothed) power reading every few seconds,
+    so the true power is desmoothed whenever the reported power changes,
+    using the previous reported power as the prior and a smoothing parameter
+    scaled to the time since the previous change. Until a first change is
+    seen it is unknown when the reading was last updated, so the true power
+    is only known from the second change onwards."""
+
+    def __init__(self, uevent_path: Path = psu.BAT0_PATH / "uevent", history=60):
+        self.fd = os.open(uevent_path, os.O_RDONLY)
+        self.last_reported: int | None = None
+        self.last_changed: float | None = None
+        self.true_power: float | None = None
+        self.power_history: deque[float] = deque(maxlen=history)
+        self.true_power_history: deque[float] = deque(maxlen=history)
+
+    def read(self) -> psu.BatteryInfo:
+        info = psu.parse_uevent(os.pread(self.fd, 4096, 0).decode())
+        if self.last_reported is not None and info.power_now != self.last_reported:
+            now = time.monotonic()
+            if self.last_changed is not None:
+                self.true_power = psu.desmooth_power_reading(
+                    info.power_now,
+                    self.last_reported,
+                    psu.smoothing_alpha(now - self.last_changed),
+                )
+            self.last_changed = now
+        self.last_reported = info.power_now
+        self.power_history.append(info.power_now / 1e6)
+        if self.true_power is not None:
+            self.true_power_history.append(self.true_power / 1e6)
+        return info
+
+    def close(self):
+        os.close(self.fd)
+
+
+def render(
+    tracker: PowerTracker,
+    info: psu.BatteryInfo,
+    usage: list[tuple[str, float]],
+    top: int = 10,
+):
+    status = batt.BatteryStatus.from_info(info)
+    table = status.table
+    if tracker.true_power is not None:
+        sign = "+" if status.status == "Charging" else "-"
+        table.add_row("True power", f"{sign}{tracker.true_power / 1e6:.01f}W")
+    table.add_row("Power history", sparkline(tracker.power_history))
+    table.add_row("True power history", sparkline(tracker.true_power_history))
+
+    processes = Table(box=box.MINIMAL, title="Top processes")
+    processes.add_column("Process")
+    processes.add_column("CPU", justify="right")
+    for name, cores in usage[:top]:
+        processes.add_row(name, f"{100 * cores:.01f}%")
+
+    return Group(table, processes)
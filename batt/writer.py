@@ -0,0 +1,236 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass
+from enum import Enum
+from pathlib import Path
+
+from batt.anomaly import Anomaly
+from batt.backlight import BacklightReading
+from batt.db import BATT_DB_PATH, Database
+from batt.proc import ProcessStat
+from batt.psu import BatteryInfo, CapacityLevel, LowLevelBatteryStatus
+from batt.system_states import StateTransition, SystemState
+
+logger = logging.getLogger(__name__)
+
+SPOOL_PATH = Path(
+    os.environ.get(
+        "BATT_SPOOL_PATH", BATT_DB_PATH.with_name(f"{BATT_DB_PATH.name}.spool")
+    )
+)
+
+
+@dataclass
+class StatusSample:
+    info: BatteryInfo
+    timestamp: int
+
+
+Record = StatusSample | StateTransition | BacklightReading | ProcessStat | Anomaly
+
+
+def insert_record(database: Database, record: Record):
+    match record:
+        case StatusSample(info, timestamp):
+            database.insert_battery_status(info, timestamp)
+        case StateTransition():
+            database.insert_state_transition(record)
+        case BacklightReading():
+            database.insert_backlight_reading(record)
+        case ProcessStat():
+            database.insert_process_stat(record)
+        case Anomaly():
+            database.insert_anomaly(record)
+
+
+def encode_record(record: Record) -> str:
+    """Encode a record as a line of JSON for the spool file"""
+    kind = type(record).__name__
+    return json.dumps(
+        {"kind": kind, "record": asdict(record)},
+        default=lambda o: o.value if isinstance(o, Enum) else str(o),
+    )
+
+
+def decode_record(line: str) -> Record:
+    """Inverse of encode_record"""
+    parsed = json.loads(line)
+    fields = parsed["record"]
+    match parsed["kind"]:
+        case "StatusSample":
+            info = fields["info"]
+            info["status"] = LowLevelBatteryStatus(info["status"])
+            info["capacity_level"] = CapacityLevel(info["capacity_level"])
+            return StatusSample(BatteryInfo(**info), fields["timestamp"])
+        case "StateTransition":
+            return StateTransition.from_values(
+                fields["timestamp"], fields["initial"], fields["final"]
+            )
+        case "BacklightReading":
+            return BacklightReading(**fields)
+        case "ProcessStat":
+            return ProcessStat(**fields)
+        case "Anomaly":
+            fields["system_state"] = SystemState(fields["system_state"])
+            return Anomaly(**fields)
+        case kind:
+            raise ValueError(f"Unknown spooled record kind: {kind}")
+
+
+class BufferedWriter:
+    """Writes records to the database from a background thread.
+
+    Records are queued without waiting on the database and written in
+    batches, once batch_size records are queued or flush_interval seconds
+    have passed. Batches that cannot be written (e.g. the database is locked)
+    and records that do not fit in the queue are appended to a spool file,
+    which is replayed into the database when the writer is next started.
+
+    Provides the same insert methods as Database so that it can be used in
+    its place."""
+
+    def __init__(
+        self,
+        database: Database,
+        spool_path: Path = SPOOL_PATH,
+        max_queued: int = 10_000,
+        batch_size: int = 1000,
+        flush_interval: float = 5.0,
+    ):
+        self.database = database
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: queue.Queue[Record | None] = queue.Queue(maxsize=max_queued)
+        self.spool_lock = threading.Lock()
+        self.live_processes: list[ProcessStat] | None = None
+        self.thread = threading.Thread(target=self.run, name="batt-writer", daemon=True)
+
+    def start(self):
+        self.replay_spool()
+        self.thread.start()
+
+    def close(self, timeout: float = 30.0):
+        """Write all queued records and stop the writer thread. Records that
+        the writer thread cannot take within timeout seconds are spooled."""
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                logger.warning("Writer thread is not keeping up, spooling queue")
+            else:
+                self.thread.join(timeout)
+        self.spool_queued()
+
+    def spool_queued(self):
+        """Spool records left in the queue"""
+        remaining = []
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is not None:
+                remaining.append(record)
+        if remaining:
+            self.spool(remaining)
+
+    def submit(self, record: Record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.spool([record])
+
+    def insert_battery_status(self, info: BatteryInfo, timestamp: int):
+        self.submit(StatusSample(info, timestamp))
+
+    def insert_state_transition(self, st: StateTransition):
+        self.submit(st)
+
+    def insert_backlight_reading(self, br: BacklightReading):
+        self.submit(br)
+
+    def insert_process_stat(self, proc: ProcessStat):
+        self.submit(proc)
+
+    def insert_anomaly(self, anomaly: Anomaly):
+        self.submit(anomaly)
+
+    def prune_process_identity_cache(self, live: list[ProcessStat]):
+        # Applied from the writer thread, which owns the identity cache
+        self.live_processes = live
+
+    def run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                record = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                pass
+            else:
+                if record is None:
+                    self.flush(batch)
+                    return
+                batch.append(record)
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self.flush(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def flush(self, batch: list[Record]):
+        """Write a batch, spooling it if it cannot be written. Never raises,
+        so that an unexpected error does not stop the writer thread."""
+        if batch:
+            try:
+                with self.database.write():
+                    for record in batch:
+                        insert_record(self.database, record)
+            except Exception as e:
+                if not isinstance(e, sqlite3.Error):
+                    logger.exception("Unexpected error writing samples, spooling")
+                try:
+                    self.spool(batch)
+                except Exception:
+                    logger.exception("Could not spool %d samples", len(batch))
+        if (live := self.live_processes) is not None:
+            self.live_processes = None
+            try:
+                self.database.prune_process_identity_cache(live)
+            except Exception:
+                logger.exception("Could not prune the process identity cache")
+
+    def spool(self, records: list[Record]):
+        lines = "".join(f"{encode_record(record)}\n" for record in records)
+        with self.spool_lock, open(self.spool_path, "a") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replay_spool(self):
+        """Insert spooled records into the database and remove the spool.
+        The spool is kept if the database is still unavailable."""
+        with self.spool_lock:
+            if not self.spool_path.exists():
+                return
+            records = []
+            with open(self.spool_path) as f:
+                for line in f:
+                    try:
+                        records.append(decode_record(line))
+                    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                        # Partially written line from a crash while spooling
+                        continue
+            try:
+                with self.database.write():
+                    for record in records:
+                        insert_record(self.database, record)
+            except sqlite3.Error:
+                return
+            self.spool_path.unlink()